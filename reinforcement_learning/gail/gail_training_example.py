@@ -12,28 +12,48 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
 import gym
 import numpy as np
+import os
+import pathlib
 import pickle
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
 
 import nnabla as nn
 import nnabla.functions as F
 import nnabla.parametric_functions as PF
 import nnabla.initializer as I
 import nnabla.solvers as S
+from nnabla.ext_utils import get_extension_context
+import nnabla_rl as rl
 import nnabla_rl.hooks as H
 import nnabla_rl.initializers as RI
 from nnabla_rl.distributions import Gaussian, Distribution
 from nnabla_rl.models.reward_function import RewardFunction
-from nnabla_rl.algorithms import GAIL, GAILConfig
+from nnabla_rl.algorithms import GAIL, GAILConfig, register_algorithm
 from nnabla_rl.builders import ModelBuilder, SolverBuilder
+from nnabla_rl.environments.environment_info import EnvironmentInfo
 from nnabla_rl.environments.wrappers import ScreenRenderEnv, NumpyFloat32Env
 from nnabla_rl.models import StochasticPolicy, VFunction
-from nnabla_rl.utils.reproductions import build_mujoco_env, d4rl_dataset_to_experiences  # noqa
-from nnabla_rl.replay_buffers import ReplacementSamplingReplayBuffer  # noqa
+from nnabla_rl.replay_buffer import ReplayBuffer
+from nnabla_rl.utils.reproductions import build_mujoco_env, d4rl_dataset_to_experiences
+from nnabla_rl.replay_buffers import ReplacementSamplingReplayBuffer
+from nnabla_rl.utils import files
+from nnabla_rl.utils.data import marshal_experiences
 from nnabla_rl.utils.evaluator import EpisodicEvaluator
+from nnabla_rl.utils.misc import create_variable
+from nnabla_rl.utils.serializers import _create_training_info, _save_training_info, _save_solver_states
 from nnabla_rl.writers import FileWriter
 
+# Gains of the orthogonal initializers. Initializers themselves are created in each model method,
+# so that they use the random number generator in effect when the model is built
+_SQRT2 = float(np.sqrt(2.0))
+_SQRT001 = float(np.sqrt(0.01))
+
 
 def build_classic_control_env(env_name, render=False):
     env = gym.make(env_name)
@@ -44,35 +64,83 @@ def build_classic_control_env(env_name, render=False):
     return env
 
 
+def build_vectorized_env(env_name, n_envs, build_env=build_classic_control_env):
+    # each environment runs on its own subprocess and is stepped in parallel
+    # observations are not copied from the shared memory. ExampleGAIL copies them to its rollout buffers
+    return gym.vector.AsyncVectorEnv([partial(build_env, env_name) for _ in range(n_envs)], copy=False)
+
+
+def build_half_precision_context(algorithm_config, allow_fp16):
+    """Build the context to compute the model in fp16.
+
+    Parameters and solver states stay in fp32. nnabla casts them to fp16 when computing in this context.
+    Returns None when fp16 is not allowed or the training runs on cpu.
+    The training also runs on cpu when the cudnn extension is not installed, same as nnabla_rl's get_nnabla_context.
+    """
+    if not allow_fp16 or algorithm_config.gpu_id < 0:
+        return None
+    try:
+        return get_extension_context("cudnn", device_id=algorithm_config.gpu_id, type_config="half")
+    except ModuleNotFoundError:
+        return None
+
+
+def compute_context_scope(ctx):
+    return contextlib.nullcontext() if ctx is None else nn.context_scope(ctx)
+
+
+class GaussianHeadInitializer(I.BaseInitializer):
+    """Initializer of the layer which outputs the mean and ln_var of gaussian.
+
+    Weights of the ln_var part are scaled by 2.0 compared to the given initializer.
+    Therefore, the output can be used as ln_var (= ln_sigma * 2.0) without the multiplication.
+    """
+
+    def __init__(self, initializer, action_dim):
+        self._initializer = initializer
+        self._action_dim = action_dim
+
+    def __call__(self, shape):
+        w = self._initializer(shape)
+        w[..., self._action_dim:] *= 2.0
+        return w
+
+
 class ExampleClassicControlVFunction(VFunction):
-    def __init__(self, scope_name: str):
+    def __init__(self, scope_name: str, compute_context=None):
         super(ExampleClassicControlVFunction, self).__init__(scope_name)
+        self._compute_context = compute_context
 
     def v(self, s: nn.Variable) -> nn.Variable:
         with nn.parameter_scope(self.scope_name):
-            with nn.parameter_scope("affine1"):
-                h = PF.affine(s, n_outmaps=64)
-                h = F.relu(h)
-            with nn.parameter_scope("affine2"):
-                h = PF.affine(h, n_outmaps=64)
-                h = F.relu(h)
+            with compute_context_scope(self._compute_context):
+                with nn.parameter_scope("affine1"):
+                    h = PF.affine(s, n_outmaps=64)
+                    h = F.relu(h)
+                with nn.parameter_scope("affine2"):
+                    h = PF.affine(h, n_outmaps=64)
+                    h = F.relu(h)
+            # output layer is always computed in fp32
             with nn.parameter_scope("affine3"):
                 h = PF.affine(h, n_outmaps=1)
         return h
 
 
 class ExampleMujocoVFunction(VFunction):
-    def __init__(self, scope_name: str):
+    def __init__(self, scope_name: str, compute_context=None):
         super(ExampleMujocoVFunction, self).__init__(scope_name)
+        self._compute_context = compute_context
 
     def v(self, s: nn.Variable) -> nn.Variable:
         with nn.parameter_scope(self.scope_name):
-            h = PF.affine(s, n_outmaps=100, name="linear1",
-                          w_init=RI.NormcInitializer(std=1.0))
-            h = F.tanh(x=h)
-            h = PF.affine(h, n_outmaps=100, name="linear2",
-                          w_init=RI.NormcInitializer(std=1.0))
-            h = F.tanh(x=h)
+            with compute_context_scope(self._compute_context):
+                h = PF.affine(s, n_outmaps=100, name="linear1",
+                              w_init=RI.NormcInitializer(std=1.0))
+                h = F.tanh(x=h)
+                h = PF.affine(h, n_outmaps=100, name="linear2",
+                              w_init=RI.NormcInitializer(std=1.0))
+                h = F.tanh(x=h)
+            # output layer is always computed in fp32
             h = PF.affine(h, n_outmaps=1, name="linear3",
                           w_init=RI.NormcInitializer(std=1.0))
         return h
@@ -87,18 +155,17 @@ class ExampleClassicControlPolicy(StochasticPolicy):
         with nn.parameter_scope(self.scope_name):
             with nn.parameter_scope("affine1"):
                 h = PF.affine(s, n_outmaps=64,
-                              w_init=I.OrthogonalInitializer(np.sqrt(2.0)))
+                              w_init=I.OrthogonalInitializer(_SQRT2))
                 h = F.relu(h)
             with nn.parameter_scope("affine2"):
                 h = PF.affine(h, n_outmaps=64,
-                              w_init=I.OrthogonalInitializer(np.sqrt(2.0)))
+                              w_init=I.OrthogonalInitializer(_SQRT2))
                 h = F.relu(h)
             with nn.parameter_scope("affine3"):
                 h = PF.affine(h, n_outmaps=self._action_dim * 2,
-                              w_init=I.OrthogonalInitializer(np.sqrt(0.01)))
-            reshaped = F.reshape(h, shape=(-1, 2, self._action_dim))
-            mean, ln_sigma = F.split(reshaped, axis=1)
-            ln_var = ln_sigma * 2.0
+                              w_init=GaussianHeadInitializer(I.OrthogonalInitializer(_SQRT001), self._action_dim))
+            mean = F.slice(h, start=(0, 0), stop=(h.shape[0], self._action_dim))
+            ln_var = F.slice(h, start=(0, self._action_dim), stop=(h.shape[0], self._action_dim * 2))
         return Gaussian(mean=mean, ln_var=ln_var)
 
 
@@ -117,32 +184,41 @@ class ExampleMujocoPolicy(StochasticPolicy):
             h = F.tanh(x=h)
             mean = PF.affine(h, n_outmaps=self._action_dim,
                              name="linear3", w_init=RI.NormcInitializer(std=0.01))
+            # s.shape[0] is read only when the graph is built. Separate graphs are built for acting
+            # (batch size n_envs with the vectorized rollout, 1 with a single env) and for training (pi_batch_size),
+            # so each graph already has a fixed shape
             assert mean.shape == (s.shape[0], self._action_dim)
-            ln_sigma = nn.parameter.get_parameter_or_create(
-                "ln_sigma", shape=(1, self._action_dim), initializer=I.ConstantInitializer(0.0)
+            # learn ln_var (= ln_sigma * 2.0) directly. Initial value is the same as ln_sigma = 0.0
+            ln_var = nn.parameter.get_parameter_or_create(
+                "ln_var", shape=(1, self._action_dim), initializer=I.ConstantInitializer(0.0)
             )
-            ln_var = F.broadcast(
-                ln_sigma, (s.shape[0], self._action_dim)) * 2.0
+            # Gaussian requires mean and ln_var of the same shape. Keep the broadcast
+            ln_var = F.broadcast(ln_var, (s.shape[0], self._action_dim))
         return Gaussian(mean, ln_var)
 
 
 class ExampleClassicDiscriminator(RewardFunction):
-    def __init__(self, scope_name: str):
+    def __init__(self, scope_name: str, compute_context=None):
         super(ExampleClassicDiscriminator, self).__init__(scope_name)
+        self._compute_context = compute_context
 
     def r(self, s_current: nn.Variable, a_current: nn.Variable, s_next: nn.Variable) -> nn.Variable:
         """
         Notes:
             In gail, we don't use the next state.
+            State and action are not concatenated in advance because
+            GAIL's state preprocessor normalizes s_current before this function is called.
         """
         h = F.concatenate(s_current, a_current, axis=1)
         with nn.parameter_scope(self.scope_name):
-            h = PF.affine(h, n_outmaps=64, name="linear1",
-                          w_init=RI.GlorotUniform(h.shape[1], 64))
-            h = F.tanh(x=h)
-            h = PF.affine(h, n_outmaps=64, name="linear2",
-                          w_init=RI.GlorotUniform(h.shape[1], 64))
-            h = F.tanh(x=h)
+            with compute_context_scope(self._compute_context):
+                h = PF.affine(h, n_outmaps=64, name="linear1",
+                              w_init=RI.GlorotUniform(h.shape[1], 64))
+                h = F.tanh(x=h)
+                h = PF.affine(h, n_outmaps=64, name="linear2",
+                              w_init=RI.GlorotUniform(h.shape[1], 64))
+                h = F.tanh(x=h)
+            # logits are always computed in fp32 to keep the binary cross entropy stable
             h = PF.affine(h, n_outmaps=1, name="linear3",
                           w_init=RI.GlorotUniform(h.shape[1], 1))
 
@@ -150,22 +226,27 @@ class ExampleClassicDiscriminator(RewardFunction):
 
 
 class ExampleMujocoDiscriminator(RewardFunction):
-    def __init__(self, scope_name: str):
+    def __init__(self, scope_name: str, compute_context=None):
         super(ExampleMujocoDiscriminator, self).__init__(scope_name)
+        self._compute_context = compute_context
 
     def r(self, s_current: nn.Variable, a_current: nn.Variable, s_next: nn.Variable) -> nn.Variable:
         """
         Notes:
             In gail, we don't use the next state.
+            State and action are not concatenated in advance because
+            GAIL's state preprocessor normalizes s_current before this function is called.
         """
         h = F.concatenate(s_current, a_current, axis=1)
         with nn.parameter_scope(self.scope_name):
-            h = PF.affine(h, n_outmaps=100, name="linear1",
-                          w_init=RI.GlorotUniform(h.shape[1], 100))
-            h = F.tanh(x=h)
-            h = PF.affine(h, n_outmaps=100, name="linear2",
-                          w_init=RI.GlorotUniform(h.shape[1], 100))
-            h = F.tanh(x=h)
+            with compute_context_scope(self._compute_context):
+                h = PF.affine(h, n_outmaps=100, name="linear1",
+                              w_init=RI.GlorotUniform(h.shape[1], 100))
+                h = F.tanh(x=h)
+                h = PF.affine(h, n_outmaps=100, name="linear2",
+                              w_init=RI.GlorotUniform(h.shape[1], 100))
+                h = F.tanh(x=h)
+            # logits are always computed in fp32 to keep the binary cross entropy stable
             h = PF.affine(h, n_outmaps=1, name="linear3",
                           w_init=RI.GlorotUniform(h.shape[1], 1))
 
@@ -184,49 +265,475 @@ class ExamplePolicyBuilder(ModelBuilder):
 
 
 class ExampleVFunctionBuilder(ModelBuilder):
-    def __init__(self, is_mujoco=False):
+    def __init__(self, is_mujoco=False, allow_fp16=False):
         self._is_mujoco = is_mujoco
+        self._allow_fp16 = allow_fp16
 
     def build_model(self, scope_name, env_info, algorithm_config, **kwargs):
+        compute_context = build_half_precision_context(algorithm_config, self._allow_fp16)
         if self._is_mujoco:
-            return ExampleMujocoVFunction(scope_name)
+            return ExampleMujocoVFunction(scope_name, compute_context=compute_context)
         else:
-            return ExampleClassicControlVFunction(scope_name)
+            return ExampleClassicControlVFunction(scope_name, compute_context=compute_context)
 
 
 class ExampleVSolverBuilder(SolverBuilder):
     def build_solver(self, env_info, algorithm_config, **kwargs):
         config: GAILConfig = algorithm_config
+        # nnabla's solver updates all the registered parameters in C++ with a single update() call
         solver = S.Adam(alpha=config.vf_learning_rate)
         return solver
 
 
 class ExampleRewardFunctionBuilder(ModelBuilder):
-    def __init__(self, is_mujoco=False):
+    def __init__(self, is_mujoco=False, allow_fp16=False):
         self._is_mujoco = is_mujoco
+        self._allow_fp16 = allow_fp16
 
     def build_model(self, scope_name, env_info, algorithm_config, **kwargs):
+        compute_context = build_half_precision_context(algorithm_config, self._allow_fp16)
         if self._is_mujoco:
-            return ExampleMujocoDiscriminator(scope_name)
+            return ExampleMujocoDiscriminator(scope_name, compute_context=compute_context)
         else:
-            return ExampleClassicDiscriminator(scope_name)
+            return ExampleClassicDiscriminator(scope_name, compute_context=compute_context)
 
 
 class ExampleRewardFunctionSolverBuilder(SolverBuilder):
     def build_solver(self, env_info, algorithm_config, **kwargs):
         config: GAILConfig = algorithm_config
+        # same as the v function solver. A single update() call updates all the parameters in C++
         solver = S.Adam(alpha=config.discriminator_learning_rate)
         return solver
 
 
+class SoAExpertBuffer(object):
+    """Expert buffer which stores the states, actions and next states of the experiences in contiguous arrays.
+
+    Experiences are written to the preallocated arrays once at startup.
+    Sampling the batch then becomes a single index gather of each array
+    instead of collecting and stacking the experiences one by one.
+    Rewards and terminal flags are not used by the discriminator, so they are not stored.
+    Same as ReplacementSamplingReplayBuffer, experiences are sampled with replacement.
+
+    Args:
+        experiences (ReplayBuffer or Sequence[Experience]): expert experiences
+    """
+
+    def __init__(self, experiences):
+        num_experiences = len(experiences)
+        s, a, *_ = experiences[0]
+        self._s_current = np.empty((num_experiences, ) + np.shape(s), dtype=np.float32)
+        self._a_current = np.empty((num_experiences, ) + np.shape(a), dtype=np.float32)
+        self._s_next = np.empty_like(self._s_current)
+        for i in range(num_experiences):
+            s, a, _, _, s_next, *_ = experiences[i]
+            self._s_current[i] = s
+            self._a_current[i] = a
+            self._s_next[i] = s_next
+
+    def __len__(self):
+        return len(self._s_current)
+
+    def sample(self, num_samples):
+        """Sample num_samples experiences.
+
+        Returns:
+            Dict[str, np.ndarray]: Batch of each element of the experiences.
+                Keys are "s_current", "a_current" and "s_next".
+        """
+        indices = rl.random.drng.integers(len(self), size=num_samples)
+        return {"s_current": self._s_current[indices],
+                "a_current": self._a_current[indices],
+                "s_next": self._s_next[indices]}
+
+
+def load_expert_buffer(path):
+    with open(path, mode="rb") as f:
+        expert_buffer = pickle.load(f)
+    return SoAExpertBuffer(expert_buffer)
+
+
+def load_d4rl_expert_buffer(env_name, size=4000):
+    dataset = build_mujoco_env(env_name).get_dataset()
+    expert_buffer = ReplacementSamplingReplayBuffer(capacity=size)
+    expert_buffer.append_all(d4rl_dataset_to_experiences(dataset, size=size))
+    return SoAExpertBuffer(expert_buffer)
+
+
+def _extract_terminal_info(infos, index):
+    """Extract the final observation and the time limit flag of the finished environment from vectorized env's infos.
+
+    gym 0.22 and 0.23 return a tuple of info dicts (one for each environment),
+    gym 0.24 and 0.25 return a dict of arrays.
+    """
+    if isinstance(infos, dict):
+        key = "final_observation" if "final_observation" in infos else "terminal_observation"
+        timelimit = infos["TimeLimit.truncated"][index] if "TimeLimit.truncated" in infos else False
+        return infos[key][index], bool(timelimit)
+    info = infos[index]
+    return info["terminal_observation"], bool(info.get("TimeLimit.truncated", False))
+
+
+class _LockedModelTrainer(object):
+    """Model trainer which holds the given lock while training. Other attributes are taken from the wrapped trainer."""
+
+    def __init__(self, trainer, lock):
+        self._trainer = trainer
+        self._lock = lock
+
+    def train(self, *args, **kwargs):
+        with self._lock:
+            return self._trainer.train(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._trainer, name)
+
+
+class ExampleGAIL(GAIL):
+    """GAIL which overlaps the rollout with the model updates.
+
+    The rollout of the next iteration depends only on the policy.
+    Therefore, it is started in a background thread right after the policy update
+    and runs while the v function and the discriminator are trained.
+    Collected experiences are labeled after the discriminator update.
+    nnabla's arrays and scopes are not thread safe. Each training step of the v function and the discriminator,
+    and each action selection of the rollout, holds a lock, so graph construction and forwards never run at once.
+    Hooks which use the parameters must run at the multiples of parameter_hook_timing.
+    At these iterations the rollout finishes before the hooks are invoked.
+    With the default parameter_hook_timing=1, the rollout finishes before the hooks of every iteration,
+    so it does not overlap the training. Pass the timing of the hooks to enable the overlap.
+
+    Expert experiences are sampled from SoAExpertBuffer.
+    If expert_buffer is not a SoAExpertBuffer, it is converted at initialization.
+
+    Vectorized rollout writes the transitions to the buffers allocated once and reused in every iteration.
+
+    Rewards and values of each episode used in GAE are computed with a single forward
+    of the discriminator and the v function.
+    The graphs are built once with the batch size of the longest episode of the rollout and reused for all episodes.
+    If an episode does not fit, for example in an env without time limit, the graphs are rebuilt with its length.
+
+    Notes:
+        GAE uses the value of the next state, delta_t = r_t + gamma * V(s_{t+1}) - V(s_t), as in the GAE paper.
+        Rewards and values are copied out of the graph outputs, so later forwards of the padded graphs
+        do not change them. They are not meant to reproduce the values of nnabla_rl's GAIL.
+    """
+
+    def __init__(self, env_or_env_info, expert_buffer, *args, async_rollout=True, parameter_hook_timing=1,
+                 **kwargs):
+        super(ExampleGAIL, self).__init__(env_or_env_info, expert_buffer, *args, **kwargs)
+        if isinstance(expert_buffer, SoAExpertBuffer):
+            self._soa_expert_buffer = expert_buffer
+        else:
+            self._soa_expert_buffer = SoAExpertBuffer(expert_buffer)
+        self._async_rollout = async_rollout
+        self._parameter_hook_timing = parameter_hook_timing
+        self._nnabla_lock = threading.Lock()
+        # created for each training, because the executor is shut down at the end of the training
+        self._rollout_executor = None
+        self._rollout_future = None
+        self._rollout_env = None
+        # set from the rollout env at the first training iteration
+        self._graph_batch_size = None
+        self._v_graph = None
+        self._reward_graph = None
+        self._rollout_buffers = [None, None]
+        self._rollout_buffer_index = 0
+        self._last_iteration = sys.maxsize
+
+    def train_online(self, train_env, total_iterations=sys.maxsize):
+        # total_iterations is counted from the current iteration, e.g. when resuming from a snapshot
+        self._last_iteration = self.iteration_num + total_iterations
+        super(ExampleGAIL, self).train_online(train_env, total_iterations=total_iterations)
+
+    def _before_training_start(self, env_or_buffer):
+        super(ExampleGAIL, self)._before_training_start(env_or_buffer)
+        # the v function and the discriminator are trained while the rollout runs in background.
+        # Trainers may be kept from the previous training. Do not wrap them twice
+        if not isinstance(self._v_function_trainer, _LockedModelTrainer):
+            self._v_function_trainer = _LockedModelTrainer(self._v_function_trainer, self._nnabla_lock)
+        if not isinstance(self._discriminator_trainer, _LockedModelTrainer):
+            self._discriminator_trainer = _LockedModelTrainer(self._discriminator_trainer, self._nnabla_lock)
+        # single worker. At most one rollout is in flight at a time
+        self._rollout_executor = ThreadPoolExecutor(max_workers=1)
+
+    def _run_online_training_iteration(self, env):
+        if self.iteration_num % self._config.num_steps_per_iteration != 0:
+            return
+
+        self._rollout_env = env
+        if self._graph_batch_size is None:
+            # +1 for the next state of the last step used to compute the values
+            self._graph_batch_size = self._max_episode_length(env) + 1
+        if self._rollout_future is None:
+            self._submit_rollout()
+        experiences = self._rollout_future.result()
+        self._rollout_future = None
+
+        buffer = ReplayBuffer(capacity=self._config.num_steps_per_iteration)
+        for experience in experiences:
+            buffer.append(self._label_experience(experience))
+
+        self._gail_training(buffer)
+
+    def _max_episode_length(self, env):
+        if isinstance(env, gym.vector.VectorEnv):
+            # _collect_vectorized_experiences cuts the episodes at the end of the rollout
+            return self._config.num_steps_per_iteration // env.num_envs + 1
+        # explorer runs each episode until its end
+        max_episode_steps = self._env_info.max_episode_steps
+        if np.isfinite(max_episode_steps):
+            return int(max_episode_steps)
+        # no time limit. Graphs are rebuilt in _fit_graph_batch_size when a longer episode comes
+        return self._config.num_steps_per_iteration
+
+    def _fit_graph_batch_size(self, batch_size):
+        if batch_size > self._graph_batch_size:
+            self._graph_batch_size = batch_size
+            self._v_graph = None
+            self._reward_graph = None
+
+    def _label_experience(self, experience):
+        # label all transitions of the episode with single forward
+        s = np.stack([transition[0] for transition in experience])
+        a = np.stack([transition[1] for transition in experience])
+        s_next = np.stack([transition[4] for transition in experience])
+        rewards = self._compute_reward(s, a, s_next)
+        return [(s_t, a_t, reward, non_terminal, n_s, info)
+                for (s_t, a_t, _, non_terminal, n_s, info), reward in zip(experience, rewards)]
+
+    def _compute_reward(self, s, a, s_next):
+        self._fit_graph_batch_size(len(s))
+        if self._reward_graph is None:
+            s_var = create_variable(self._graph_batch_size, self._env_info.state_shape)
+            a_var = create_variable(self._graph_batch_size, self._env_info.action_shape)
+            s_next_var = create_variable(self._graph_batch_size, self._env_info.state_shape)
+            logits_fake = self._discriminator.r(s_var, a_var, s_next_var)
+            # -log(1 - sigmoid(logits)) is the sigmoid cross entropy of label 0.
+            # Compute it with single function instead of sigmoid, log and arithmetic functions
+            reward = F.sigmoid_cross_entropy(logits_fake, F.constant(0, logits_fake.shape))
+            self._reward_graph = (s_var, a_var, s_next_var, reward)
+        s_var, a_var, s_next_var, reward = self._reward_graph
+        # rows after the episode keep the previous inputs. Their outputs are discarded
+        batch_size = len(s)
+        s_var.d[:batch_size] = s
+        a_var.d[:batch_size] = a
+        s_next_var.d[:batch_size] = s_next
+        reward.forward(clear_buffer=True)
+        # copy. The output is overwritten when labeling the next episode
+        return np.array(reward.d[:batch_size], dtype=np.float32)
+
+    def _policy_training(self, s, a, v_target, advantage):
+        super(ExampleGAIL, self)._policy_training(s, a, v_target, advantage)
+        # no rollout is needed after the last training iteration
+        next_training_iteration = self.iteration_num + self._config.num_steps_per_iteration
+        if self._async_rollout and next_training_iteration <= self._last_iteration:
+            self._submit_rollout()
+
+    def _exploration_action_selector(self, *args, **kwargs):
+        with self._nnabla_lock:
+            return super(ExampleGAIL, self)._exploration_action_selector(*args, **kwargs)
+
+    def _invoke_hooks(self):
+        # Hooks such as EvaluationHook and AsyncSaveSnapshotHook read the policy parameters outside of the lock.
+        # Let the rollout finish before running them. The result is kept for the next training iteration
+        if self._rollout_future is not None and self.iteration_num % self._parameter_hook_timing == 0:
+            wait([self._rollout_future])
+        super(ExampleGAIL, self)._invoke_hooks()
+
+    def _compute_v_target_and_advantage(self, buffer_iterator):
+        v_target_batch = []
+        adv_batch = []
+
+        buffer_iterator.reset()
+        for experiences, *_ in buffer_iterator:
+            # length of experiences is 1
+            v_target, adv = self._compute_episode_v_target_and_advantage(experiences[0])
+            v_target_batch.append(v_target)
+            adv_batch.append(adv)
+
+        adv_batch = np.concatenate(adv_batch, axis=0)
+        v_target_batch = np.concatenate(v_target_batch, axis=0)
+
+        adv_mean = np.mean(adv_batch)
+        adv_std = np.std(adv_batch)
+        adv_batch = (adv_batch - adv_mean) / adv_std
+        return v_target_batch, adv_batch
+
+    def _compute_episode_v_target_and_advantage(self, experiences):
+        s, _, r, non_terminal, s_next, *_ = marshal_experiences(experiences)
+        # compute the values of all states and the last next state at once
+        v = self._compute_v(np.concatenate([s, s_next[-1:]], axis=0)).reshape(-1)
+        r = r.reshape(-1)
+        non_terminal = non_terminal.reshape(-1)
+
+        gamma = self._config.gamma
+        lmb = self._config.lmb
+        T = len(experiences)
+        advantages = np.empty(shape=(T, ), dtype=np.float32)
+        advantage = np.float32(0.)
+        for t in reversed(range(T)):
+            delta = r[t] + gamma * non_terminal[t] * v[t + 1] - v[t]
+            advantage = np.float32(delta + gamma * lmb * non_terminal[t] * advantage)
+            advantages[t] = advantage
+        # A = Q - V, V = E[Q] -> v_target = A + V
+        v_targets = advantages + v[:T]
+        return v_targets.reshape(-1, 1), advantages.reshape(-1, 1)
+
+    def _compute_v(self, s):
+        self._fit_graph_batch_size(len(s))
+        if self._v_graph is None:
+            s_var = create_variable(self._graph_batch_size, self._env_info.state_shape)
+            self._v_graph = (s_var, self._v_function.v(s_var))
+        s_var, v = self._v_graph
+        # rows after the episode keep the previous inputs. Their outputs are discarded
+        batch_size = len(s)
+        s_var.d[:batch_size] = s
+        v.forward(clear_buffer=True)
+        return np.array(v.d[:batch_size], dtype=np.float32)
+
+    def _align_discriminator_experiences(self, buffer_iterator):
+        batch_size = self._config.discriminator_batch_size
+        expert_batch = self._soa_expert_buffer.sample(batch_size)
+        s_expert_batch = expert_batch["s_current"]
+        a_expert_batch = expert_batch["a_current"]
+        s_next_expert_batch = expert_batch["s_next"]
+        s_batch, a_batch, s_next_batch = self._align_state_and_action(buffer_iterator, batch_size=batch_size)
+        return s_expert_batch, a_expert_batch, s_next_expert_batch, s_batch, a_batch, s_next_batch
+
+    def _submit_rollout(self):
+        self._rollout_future = self._rollout_executor.submit(
+            self._collect_experiences, self._rollout_env)
+
+    def _collect_experiences(self, env):
+        if isinstance(env, gym.vector.VectorEnv):
+            return self._collect_vectorized_experiences(env)
+        experiences = []
+        num_steps = 0
+        while num_steps <= self._config.num_steps_per_iteration:
+            experience = self._environment_explorer.rollout(env)
+            experiences.append(experience)
+            num_steps += len(experience)
+        return experiences
+
+    def _collect_vectorized_experiences(self, env):
+        s_buffer, a_buffer, r_buffer, non_terminal_buffer, s_next_buffer = self._next_rollout_buffers(env)
+        episode_begins = np.zeros(env.num_envs, dtype=np.int64)
+        experiences = []
+        states = env.reset()
+        t = 0
+        # stop as soon as the finished and unfinished episodes together cover the required steps
+        while t * env.num_envs <= self._config.num_steps_per_iteration:
+            s_buffer[t] = states
+            # compute the actions of all environments with single forward
+            actions, _ = self._exploration_action_selector(s_buffer[t])
+            a_buffer[t] = np.reshape(actions, env.action_space.shape)
+            states, rewards, dones, infos = env.step(a_buffer[t])
+            s_next_buffer[t] = states
+            r_buffer[t] = rewards
+            non_terminal_buffer[t] = 1.0
+            for i in np.flatnonzero(dones):
+                # vectorized env resets finished environment automatically
+                s_next_buffer[t, i], timelimit = _extract_terminal_info(infos, i)
+                non_terminal_buffer[t, i] = 1.0 if timelimit else 0.0
+                # experiences are views of the buffers. No arrays are allocated per transition
+                episode = [(s_buffer[k, i], a_buffer[k, i], r_buffer[k, i], non_terminal_buffer[k, i],
+                            s_next_buffer[k, i], {}) for k in range(episode_begins[i], t + 1)]
+                experiences.append(episode)
+                episode_begins[i] = t + 1
+            t += 1
+        for i in range(env.num_envs):
+            # Unfinished episodes are truncated. Last transition is non terminal so GAE bootstraps from its value
+            if episode_begins[i] < t:
+                experiences.append([(s_buffer[k, i], a_buffer[k, i], r_buffer[k, i], non_terminal_buffer[k, i],
+                                     s_next_buffer[k, i], {}) for k in range(episode_begins[i], t)])
+        return experiences
+
+    def _next_rollout_buffers(self, env):
+        # Two sets of buffers are used alternately, because the next rollout runs in background
+        # while the experiences of previous rollout are still used in the training
+        self._rollout_buffer_index = 1 - self._rollout_buffer_index
+        if self._rollout_buffers[self._rollout_buffer_index] is None:
+            max_timesteps = self._config.num_steps_per_iteration // env.num_envs + 1
+            shape = (max_timesteps, env.num_envs)
+            self._rollout_buffers[self._rollout_buffer_index] = (
+                np.empty(shape + self._env_info.state_shape, dtype=np.float32),
+                np.empty(shape + self._env_info.action_shape, dtype=np.float32),
+                np.empty(shape, dtype=np.float32),
+                np.empty(shape, dtype=np.float32),
+                np.empty(shape + self._env_info.state_shape, dtype=np.float32),
+            )
+        return self._rollout_buffers[self._rollout_buffer_index]
+
+    def _after_training_finish(self, env_or_buffer):
+        self._rollout_executor.shutdown(wait=True)
+        self._rollout_executor = None
+        super(ExampleGAIL, self)._after_training_finish(env_or_buffer)
+
+
+# register to load the snapshot of ExampleGAIL with nnabla_rl.utils.serializers.load_snapshot
+register_algorithm(ExampleGAIL, GAILConfig)
+
+
+class AsyncSaveSnapshotHook(H.SaveSnapshotHook):
+    """SaveSnapshotHook which writes the network parameters in a background thread.
+
+    Parameters are copied to host memory before the training resumes, so the saved snapshot is consistent.
+    Training info and solver states are small and saved on the training thread.
+    At most one snapshot is written at a time. If the previous write has not finished yet, the hook waits for it.
+    Call wait() after the training to make sure that the last snapshot is written.
+    """
+
+    def __init__(self, outdir, timing=1000):
+        super(AsyncSaveSnapshotHook, self).__init__(outdir, timing=timing)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future = None
+
+    def on_hook_called(self, algorithm):
+        outdir = pathlib.Path(self._outdir) / ("iteration-" + str(algorithm.iteration_num))
+        files.create_dir_if_not_exist(outdir=outdir)
+        # Written with the same functions as nnabla_rl.utils.serializers.save_snapshot,
+        # so the snapshot can be loaded with load_snapshot. Only the network parameters are written in background
+        _save_training_info(outdir, _create_training_info(algorithm))
+        _save_solver_states(outdir, algorithm)
+
+        parameters = {}
+        for scope_name, model in algorithm._models().items():
+            parameters[scope_name] = {key: nn.Variable.from_numpy_array(param.d.copy(), need_grad=param.need_grad)
+                                      for key, param in model.get_parameters(grad_only=False).items()}
+        self.wait()
+        self._future = self._executor.submit(self._write_parameters, outdir, parameters)
+
+    def teardown(self, algorithm, total_iterations):
+        # Not called by older nnabla-rl. wait() is also called explicitly at the end of the training
+        self.wait()
+
+    def wait(self):
+        if self._future is not None:
+            # raises the exception occurred while writing, if any
+            self._future.result()
+            self._future = None
+
+    def _write_parameters(self, outdir, parameters):
+        for scope_name, params in parameters.items():
+            nn.save_parameters(str(outdir / (scope_name + ".h5")), params=params)
+
+
 def train():
+    # Allow TF32 tensor core math in cuBLAS/cuDNN on Ampere or later gpus.
+    # nnabla disables it by default. Remove this line if you need full fp32 precision.
+    # NOTE: nnabla's cuda extension is loaded through GAIL's "cudnn" context, so this must be set before building GAIL.
+    os.environ.setdefault("NNABLA_CUDA_ALLOW_TF32", "1")
+
     # nnabla-rl's Reinforcement learning algorithm requires environment that implements gym.Env interface
     # for the details of gym.Env see: https://github.com/openai/gym
     env_name = "Pendulum-v1"
-    train_env = build_classic_control_env(env_name)
-    # load expert dataset
-    with open("./pendulum_v1_expert_buffer.pkl", mode="rb") as f:
-        expert_buffer = pickle.load(f)
+    # train_env runs n_envs environments in parallel and the policy computes their actions in a batch.
+    # Experiences are counted in transitions, so batch sizes below do not depend on n_envs.
+    n_envs = 16
+    train_env = build_vectorized_env(env_name, n_envs)
+    # get expert dataset
+    expert_buffer = load_expert_buffer("./pendulum_v1_expert_buffer.pkl")
 
     # evaluation env is used only for running the evaluation of models during the training.
     # if you do not evaluate the model during the training, this environment is not necessary.
@@ -242,13 +749,10 @@ def train():
     # You can change the name of environment to change the environment to train.
     # You also need to install d4rl. See: https://github.com/rail-berkeley/d4rl
     # env_name = "halfcheetah-medium-v2"
-    # train_env = build_mujoco_env(env_name)
-    # eval_env = build_mujoco_env(env_name, test=True, render=True)
+    # train_env = build_vectorized_env(env_name, n_envs, build_env=build_mujoco_env)
     # get expert dataset
-    # train_dataset = train_env.get_dataset()
-    # expert_buffer = ReplacementSamplingReplayBuffer(capacity=4000)
-    # expert_experiences = d4rl_dataset_to_experiences(train_dataset, size=4000)
-    # expert_buffer.append_all(expert_experiences)
+    # expert_buffer = load_d4rl_expert_buffer(env_name, size=4000)
+    # eval_env = build_mujoco_env(env_name, test=True, render=True)
     # evaluation_timing = 50000
     # total_iterations = 25000000
     # pi_batch_size = 50000
@@ -262,6 +766,7 @@ def train():
     # Writer will save the evaluation results to file.
     # If you set writer=None, evaluator will only print the evaluation results on terminal.
     writer = FileWriter(outdir, "evaluation_result")
+    # The evaluation policy graph is built on the first evaluation and reused in later runs
     evaluator = EpisodicEvaluator(run_per_evaluation=5)
     # evaluate the trained model with eval_env every 5000 iterations
     evaluation_hook = H.EvaluationHook(
@@ -273,31 +778,44 @@ def train():
     iteration_num_hook = H.IterationNumHook(timing=100)
 
     # save the trained model every 5000 iterations
-    save_snapshot_hook = H.SaveSnapshotHook(outdir, timing=evaluation_timing)
+    # parameters are written to the files in background, so saving does not block the training
+    save_snapshot_hook = AsyncSaveSnapshotHook(outdir, timing=evaluation_timing)
 
     # Set gpu_id to -1 to train on cpu.
     gpu_id = 0
+    # Set allow_fp16 to True to compute the hidden layers of the v function and discriminator in fp16.
+    # Parameters and output layers stay in fp32. No loss scaling is applied, so check the losses when enabling this.
+    allow_fp16 = False
     config = GAILConfig(
         gpu_id=gpu_id,
         pi_batch_size=pi_batch_size,
         num_steps_per_iteration=num_steps_per_iteration,
         discriminator_batch_size=discriminator_batch_size,
     )
-    gail = GAIL(
-        train_env,
+    # vectorized env does not have the information of single environment. Take it from eval_env.
+    env_info = EnvironmentInfo.from_env(eval_env)
+    # ExampleGAIL collects the experiences of next iteration while training the v function and discriminator.
+    # Set async_rollout=False to run the rollout and training sequentially.
+    # Evaluation and snapshot hooks read the policy parameters, so the rollout is finished before they run.
+    gail = ExampleGAIL(
+        env_info,
         expert_buffer,
         config=config,
         policy_builder=ExamplePolicyBuilder(is_mujoco=is_mujoco),
-        v_function_builder=ExampleVFunctionBuilder(is_mujoco=is_mujoco),
+        v_function_builder=ExampleVFunctionBuilder(is_mujoco=is_mujoco, allow_fp16=allow_fp16),
         v_solver_builder=ExampleVSolverBuilder(),
         reward_function_builder=ExampleRewardFunctionBuilder(
-            is_mujoco=is_mujoco),
+            is_mujoco=is_mujoco, allow_fp16=allow_fp16),
         reward_solver_builder=ExampleRewardFunctionSolverBuilder(),
+        async_rollout=True,
+        parameter_hook_timing=evaluation_timing,
     )
     # Set instanciated hooks to periodically run additional jobs
     gail.set_hooks(
         hooks=[evaluation_hook, iteration_num_hook, save_snapshot_hook])
     gail.train(train_env, total_iterations=total_iterations)
+    # wait until the last snapshot is written
+    save_snapshot_hook.wait()
 
 
 if __name__ == "__main__":